@@ -11,13 +11,14 @@ No guarantee is provided whatsoever. Use at your own risk.
 # standard python includes
 from re import search, sub
 from ctypes import c_double, c_float, c_int, \
-    c_char_p, CDLL, byref, POINTER
+    c_char_p, c_void_p, CDLL, byref, POINTER
 import ctypes
-import operator
 import sys
 import os
 import copy
+import threading
 import numpy
+from numpy.lib.stride_tricks import as_strided
 import cdms2
 from regrid2 import RegridError
 
@@ -33,10 +34,79 @@ LIBCFDIR  = __path__[0] + "/pylibcf"
 
 __FILE__ = sys._getframe().f_code.co_filename
 
-def catchError(status, lineno):
+# signatures of the libcf entry points called on every apply/find call.
+# Pointer arguments are declared as c_void_p so that the raw buffer
+# address of a numpy array (ndarray.ctypes.data) can be passed directly,
+# without building a ctypes POINTER (data_as) each time.
+LIBCF_PROTOTYPES = (
+    ('nccf_compute_regrid_weights', (c_int, c_int, c_double)),
+    ('nccf_def_data', (c_int, c_char_p, c_char_p, c_char_p, c_char_p,
+                       c_void_p)),
+    ('nccf_set_data_double', (c_int, c_void_p, c_int, c_double)),
+    ('nccf_set_data_float', (c_int, c_void_p, c_int, c_float)),
+    ('nccf_apply_regrid', (c_int, c_int, c_int)),
+    ('nccf_free_data', (c_int,)),
+    ('nccf_inq_regrid_weights', (c_int, c_void_p, c_void_p, c_void_p)),
+    ('nccf_find_indices_double', (c_int, c_void_p, c_void_p, c_void_p,
+                                  c_void_p, c_void_p, c_void_p, c_void_p,
+                                  c_void_p, c_void_p)),
+    )
+
+# libcf setter and default fill value for each data type supported by
+# the interpolation
+DATA_SETTERS = {
+    numpy.dtype(numpy.float64): ('nccf_set_data_double',
+                                 libCFConfig.NC_FILL_DOUBLE),
+    numpy.dtype(numpy.float32): ('nccf_set_data_float',
+                                 libCFConfig.NC_FILL_FLOAT),
+    }
+
+# shared library handle, opened once and shared by all Regrid instances
+_libcfHandle = None
+
+def openLibCF():
+    """
+    Open the libcf shared library and declare the signatures of its
+    most frequently called functions. The library is only opened once.
+    @return ctypes handle to the library
+    """
+    global _libcfHandle
+    if _libcfHandle is not None:
+        return _libcfHandle
+
+    dynLibFound = False
+    lib = None
+    for sosuffix in '.dylib', '.dll', '.DLL', '.so', '.a':
+        if os.path.exists(LIBCFDIR + sosuffix):
+            dynLibFound = True
+            try:
+                lib = CDLL(LIBCFDIR + sosuffix)
+                break
+            except:
+                pass
+    if lib is None:
+        if not dynLibFound:
+            raise RegridError, "ERROR in %s: could not find shared library %s.{so,dylib,dll,DLL}" \
+                % (__FILE__, LIBCFDIR)
+        raise RegridError, "ERROR in %s: could not open shared library %s.{so,dylib,dll,DLL}" \
+            % (__FILE__, LIBCFDIR)
+
+    for name, argtypes in LIBCF_PROTOTYPES:
+        func = getattr(lib, name)
+        func.argtypes = argtypes
+        func.restype = c_int
+
+    _libcfHandle = lib
+    return _libcfHandle
+
+def catchError(status):
+    """
+    Raise an exception if a libcf call failed, the line of the failing
+    call is reported by the traceback
+    @param status return value of a libcf function
+    """
     if status != 0:
-        raise RegridError, "ERROR in %s: status = %d at line %d" \
-            % (__FILE__, status, lineno)
+        raise RegridError, "ERROR in %s: status = %d" % (__FILE__, status)
 
 def getTensorProduct(axis, dim, dims):
     """
@@ -46,9 +116,15 @@ def getTensorProduct(axis, dim, dims):
     @param dim dimensional index of the above coordinate
     @param dims sizes of all coordinates
     @return coordinate values obtained by tensor product
+    @note the result is a read-only view of axis (zero strides along all
+          dimensions but dim), no N-d array is allocated
     """
-    return numpy.outer(numpy.outer( numpy.ones(dims[:dim], axis.dtype), axis),
-                      numpy.ones(dims[dim+1:], axis.dtype)).reshape(dims)
+    axis = numpy.asarray(axis)
+    strides = [0] * len(dims)
+    strides[dim] = axis.strides[0]
+    res = as_strided(axis, shape = tuple(dims), strides = tuple(strides))
+    res.flags.writeable = False
+    return res
 
 def makeCurvilinear(coords):
     """
@@ -58,39 +134,54 @@ def makeCurvilinear(coords):
     @return new list of coordinates and associated dimensions
     """
     rank = len(coords)
+    nds = [len(coord.shape) for coord in coords]
+
+    if nds.count(rank) == rank:
+        # already fully curvilinear, nothing to expand
+        return coords, [coords[i].shape[i] for i in range(rank)]
 
     count1DAxes = 0
     dims = []
+    expand = []
     for i in range(rank):
         coord = coords[i]
-        if len(coord.shape) == 1:
+        nd = nds[i]
+        if nd == 1:
             # axis
             dims.append( len(coord) )
             count1DAxes += 1
-        elif len(coord.shape) == rank:
+            expand.append(i)
+        elif nd == rank:
             # fully curvilinear
             dims.append( coord.shape[i] )
         else:
             # assumption: all 1D axes preceed curvilinear
             # coordinates!!!
             dims.append( coord.shape[i - count1DAxes] )
-
-    for i in range(rank):
-        nd = len(coords[i].shape)
-        if nd == rank:
-            # already in curvilinear form, keep as is
-            pass
-        elif nd == 1:
-            # it's an axis
-            coords[i] = getTensorProduct(coords[i][:], i, dims)
-        elif rank == 3 and nd == 2 and i > 0:
-            # assume leading coordinate is an axis
-            o1 = numpy.ones( (len(coords[0]),), coords[i].dtype )
-            coords[i] = numpy.ma.outer(o1, coords[i]).reshape(dims)
-        else:
+            if rank == 3 and nd == 2 and i > 0:
+                # assume leading coordinate is an axis
+                expand.append(i)
+            else:
+                raise RegridError, \
+                    "ERROR in %s: funky mixture of axes and curvilinear coords %s" \
+                    % (__FILE__, str([x.shape for x in coords]))
+
+    for i in expand:
+        if nds[i] == 2 and coords[i].shape != tuple(dims[1:]):
             raise RegridError, \
                 "ERROR in %s: funky mixture of axes and curvilinear coords %s" \
                 % (__FILE__, str([x.shape for x in coords]))
+
+    for i in expand:
+        if nds[i] == 1:
+            coords[i] = getTensorProduct(coords[i][:], i, dims)
+        else:
+            # repeat the 2D coordinate along the leading axis, as a
+            # read-only view
+            coord = numpy.asarray(coords[i])
+            coords[i] = as_strided(coord, shape = tuple(dims),
+                                   strides = (0,) + coord.strides)
+            coords[i].flags.writeable = False
     return coords, dims
 
 def makeCoordsCyclic(coords, dims):
@@ -317,15 +408,35 @@ class Regrid:
         @note the grid coordinates can either be axes (rectilinear grid) or
               n-dimensional for curvilinear grids. Rectilinear grids will
               be converted to curvilinear grids.
+        @note coordinates that are already C contiguous float64 arrays are
+              not copied, libcf reads them in place. They must not be
+              modified afterwards (e.g. converting longitudes from 0..360
+              to -180..180), to do so pass a copy.
         """
         self.regridid = c_int(-1)
         self.src_gridid = c_int(-1)
         self.dst_gridid = c_int(-1)
+        # libcf src/dst data objects, one pair per concurrent apply call
+        # (see _acquireDataIds). Idle pairs wait in _freeData, all of the
+        # ids are kept in _dataIds for __del__
+        self._freeData = []
+        self._dataIds = []
+        self._dataLock = threading.Lock()
+        # weights extracted from libcf, see materializeWeights
+        self._dst_valid = None
+        self._indices = None
+        self._weights = None
+        self._applyPlans = {}
+        self._devicePlans = {}
         self.rank = 0
         self.src_dims = []
         self.dst_dims = []
+        self._src_dims_tuple = ()
+        self._dst_dims_tuple = ()
         self.src_coords = []
         self.dst_coords = []
+        self._src_coord_ptrs = None
+        self._no_periodicity = None
         self.lib = None
         self.extendedGrid = False
         self.handleCut = False
@@ -334,22 +445,11 @@ class Regrid:
         self.weightsComputed = False
         self.maskSet = False
 
-        # Open the shaped library
-        dynLibFound = False
-        for sosuffix in '.dylib', '.dll', '.DLL', '.so', '.a':
-	    if os.path.exists(LIBCFDIR + sosuffix):
-                dynLibFound = True
-            	try:
-                    self.lib = CDLL(LIBCFDIR + sosuffix)
-                    break
-                except:
-                    pass
-        if self.lib == None:
-            if not dynLibFound:
- 	        raise RegridError, "ERROR in %s: could not find shared library %s.{so,dylib,dll,DLL}" \
-                % (__FILE__, LIBCFDIR)
-            raise RegridError, "ERROR in %s: could not open shared library %s.{so,dylib,dll,DLL}" \
-                % (__FILE__, LIBCFDIR)
+        # Open the shared library
+        self.lib = openLibCF()
+        self._dataSetters = dict([(dtype, (getattr(self.lib, name), fill))
+                                  for dtype, (name, fill) in \
+                                      DATA_SETTERS.items()])
 
         # Number of space dimensions
         self.rank = len(src_grid)
@@ -421,16 +521,31 @@ class Regrid:
             dst_dimnames[i] = 'dst_n%d' % i
             self.src_dims[i] = src_dims[i]
             self.dst_dims[i] = dst_dims[i]
+        # python copies of the dimensions, cheaper to read than the
+        # ctypes arrays
+        self._src_dims_tuple = tuple(self.src_dims)
+        self._dst_dims_tuple = tuple(self.dst_dims)
         self.src_coordids = (c_int * self.rank)()
+        # table of pointers to the src coordinates, passed to
+        # nccf_find_indices_double
+        self._src_coord_ptrs = (POINTER(c_double) * self.rank)()
+        # periodicity lengths passed to nccf_find_indices_double
+        # (inf: not periodic), read only by libcf
+        self._no_periodicity = float('inf') * numpy.ones((self.rank,),
+                                                         numpy.float64)
         self.dst_coordids = (c_int * self.rank)()
         save = 0
         standard_name = ""
         units = ""
         coordid = c_int(-1)
+        # coordinates that are already packed float64 arrays are not copied,
+        # libcf then reads them in place (save = 0)
         for i in range(self.rank):
-            data =  numpy.array( src_grid[i], numpy.float64 )
+            data = numpy.ascontiguousarray( src_grid[i], numpy.float64 )
+            assert data.flags['C_CONTIGUOUS'], 'src coordinate %d is not packed' % i
             self.src_coords.append( data )
             dataPtr = data.ctypes.data_as(C_DOUBLE_P)
+            self._src_coord_ptrs[i] = dataPtr
             name = "src_coord%d" % i
             # assume [lev,] lat, lon ordering
             if i == self.rank - 2:
@@ -444,10 +559,11 @@ class Regrid:
                                              dataPtr, save, name,
                                              standard_name, units,
                                              byref(coordid))
-            catchError(status, sys._getframe().f_lineno)
+            catchError(status)
             self.src_coordids[i] = coordid
 
-            data =  numpy.array( dst_grid[i], numpy.float64 )
+            data = numpy.ascontiguousarray( dst_grid[i], numpy.float64 )
+            assert data.flags['C_CONTIGUOUS'], 'dst coordinate %d is not packed' % i
             self.dst_coords.append( data )
             dataPtr = data.ctypes.data_as(C_DOUBLE_P)
             name = "dst_coord%d" % i
@@ -456,22 +572,22 @@ class Regrid:
                                              dataPtr, save, name,
                                              standard_name, units,
                                              byref(coordid))
-            catchError(status, sys._getframe().f_lineno)
+            catchError(status)
             self.dst_coordids[i] = coordid
          
         # Build grid objects
         status = self.lib.nccf_def_grid(self.src_coordids, "src_grid",
                                         byref(self.src_gridid))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
         status = self.lib.nccf_def_grid(self.dst_coordids, "dst_grid",
                                         byref(self.dst_gridid))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
         # Create regrid object
         status = self.lib.nccf_def_regrid(self.src_gridid, self.dst_gridid,
                                           byref(self.regridid))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
     def getPeriodicities(self):
         """
@@ -481,29 +597,33 @@ class Regrid:
         coord_periodicity = numpy.zeros( (self.rank,), numpy.float64 )
         status = self.lib.nccf_inq_grid_periodicity(self.src_gridid,
                                  coord_periodicity.ctypes.data_as(C_DOUBLE_P))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
         return coord_periodicity
 
     def __del__(self):
         """
         Destructor, will be called automatically
         """
+        for dataid in self._dataIds:
+            status = self.lib.nccf_free_data(dataid)
+            catchError(status)
+
         status = self.lib.nccf_free_regrid(self.regridid)
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
         status = self.lib.nccf_free_grid(self.src_gridid)
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
         status = self.lib.nccf_free_grid(self.dst_gridid)
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
 
         for i in range(self.rank):
 
             status = self.lib.nccf_free_coord(self.src_coordids[i])
-            catchError(status, sys._getframe().f_lineno)
+            catchError(status)
 
             status = self.lib.nccf_free_coord(self.dst_coordids[i])
-            catchError(status, sys._getframe().f_lineno)
+            catchError(status)
 
     def setValidMask(self, inMask):
         """
@@ -524,7 +644,7 @@ class Regrid:
         c_intmask = newMask.ctypes.data_as(POINTER(c_int))
         status = self.lib.nccf_set_grid_validmask(self.src_gridid,
                                                   c_intmask)
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
         self.maskSet = True
 
     def setMask(self, inDataOrMask):
@@ -556,50 +676,82 @@ class Regrid:
         @param nitermax max number of iterations
         @param tolpos max tolerance when locating destination positions in
                index space
+        @note the GIL is released while libcf computes the weights, other
+              Python threads (e.g. reading the next field) keep running
         """
         status = self.lib.nccf_compute_regrid_weights(self.regridid,
-                                                      nitermax,
-                                                      c_double(tolpos))
-        catchError(status, sys._getframe().f_lineno)
+                                                      nitermax, tolpos)
+        catchError(status)
         self.weightsComputed = True
-
-    def apply(self, src_data_in, dst_data, missingValue = None):
+        # any previously extracted weights are stale
+        self._dst_valid = None
+        self._indices = None
+        self._weights = None
+        self._applyPlans = {}
+        self._devicePlans = {}
+
+    def apply(self, src_data_in, dst_data, missingValue = None,
+              precision = None):
         """
         Apply interpolation
         @param src_data data on source grid
         @param dst_data data on destination grid
         @param missingValue value that should be set for points falling outside the src domain, 
                             pass None if these should not be touched.
+        @param precision set to 'f4' (numpy.float32) to interpolate float64
+                         data in single precision, halving the memory
+                         traffic of the interpolation. The result is cast
+                         back into dst_data; expect relative errors of
+                         order 1.e-7 instead of 1.e-16. Values beyond
+                         +-3.4e38 overflow to inf. The first field with
+                         NaN or inf values (with missingValue None)
+                         triggers materializeWeights, i.e. one libcf call
+                         per destination point. Ignored unless both
+                         src_data and dst_data are float64.
+        @note may be called from several threads, each call uses its own
+              libcf data objects and the calls into libcf release the GIL
         """
         if not self.weightsComputed:
             raise RegridError, 'Weights must be set before applying the regrid'
+
+        if precision is not None and \
+                numpy.dtype(precision) == numpy.float32 and \
+                src_data_in.dtype == numpy.float64 and \
+                dst_data.dtype == numpy.float64:
+            src32 = src_data_in.astype(numpy.float32)
+            dst32 = numpy.empty(dst_data.shape, numpy.float32)
+            if missingValue is not None:
+                self.apply(src32, dst32, missingValue)
+                dst_data[...] = dst32
+                # the missing value may not be representable in single
+                # precision, restore it exactly
+                dst_data[dst32 == numpy.float32(missingValue)] = missingValue
+                return dst_data
+
+            # only copy back the points libcf interpolated, the others
+            # must be left untouched. These stay NaN in dst32
+            dst32[...] = numpy.nan
+            self.apply(src32, dst32)
+            if not numpy.isfinite(src32).all():
+                # NaN may also have been interpolated (NaN src values,
+                # inf times a zero weight, inf - inf), ask for the valid
+                # points instead
+                if self._weights is None:
+                    self.materializeWeights()
+                dst_data.flat[self._dst_valid] = dst32.flat[self._dst_valid]
+            else:
+                valid = ~numpy.isnan(dst32)
+                dst_data[valid] = dst32[valid]
+            return dst_data
+
         # extend src data if grid was made cyclic and or had a cut accounted for
         src_data = self._extend(src_data_in)
 
         # Check
-        if reduce(operator.iand, [src_data.shape[i] == self.src_dims[i] \
-                                 for i in range(self.rank)]) == False:
-            raise RegridError, ("ERROR in %s: supplied src_data have wrong shape " \
-                                  + "%s != %s") % (__FILE__, str(src_data.shape), \
-                                     str(tuple([d for d in self.src_dims])))
-        if reduce(operator.iand, [dst_data.shape[i] == self.dst_dims[i] \
-                                 for i in range(self.rank)]) == False:
-            raise RegridError, ("ERROR in %s: supplied dst_data have wrong shape " \
-                + "%s != %s") % (__FILE__, str(dst_data.shape),
-                                 str(tuple([d for d in self.dst_dims])))
+        self._checkShapes(src_data, dst_data)
 
-        # Create temporary data objects
-        src_dataid = c_int(-1)
-        dst_dataid = c_int(-1)
+        # the data are not copied by libcf
         save = 0
-        standard_name = ""
-        units = ""
-        time_dimname = ""
-
-        status = self.lib.nccf_def_data(self.src_gridid, "src_data", \
-                                        standard_name, units, time_dimname, \
-                                        byref(src_dataid))
-        catchError(status, sys._getframe().f_lineno)
 
         if src_data.dtype != dst_data.dtype:
             try: # try recasting
@@ -616,70 +768,238 @@ class Regrid:
                     % (__FILE__, src_data.dtype, dst_data.dtype)
 
         # only float64 and float32 data types are supported for interpolation
-        if src_data.dtype == numpy.float64:
-            fill_value = c_double(libCFConfig.NC_FILL_DOUBLE)
-            if missingValue is not None:
-                fill_value = c_double(missingValue)
-            ptr = src_data.ctypes.data_as(POINTER(c_double))
-            status = self.lib.nccf_set_data_double(src_dataid, ptr, save, fill_value)
-            catchError(status, sys._getframe().f_lineno)
-        elif src_data.dtype == numpy.float32:
-            fill_value = c_float(libCFConfig.NC_FILL_FLOAT)
-            if missingValue is not None:
-                fill_value = c_float(missingValue)
-            ptr = src_data.ctypes.data_as(POINTER(c_float))
-            status = self.lib.nccf_set_data_float(src_dataid, ptr, save, fill_value)
-            catchError(status, sys._getframe().f_lineno)
-        else:
+        srcSetter = self._dataSetters.get(src_data.dtype)
+        if srcSetter is None:
             raise RegridError, "ERROR in %s: invalid src_data type %s (neither float nor double)" \
                 % (__FILE__, src_data.dtype)
+        dstSetter = self._dataSetters.get(dst_data.dtype)
+        if dstSetter is None:
+            raise RegridError, "ERROR in %s: invalid dst_data type = %s" \
+                % (__FILE__, dst_data.dtype)
 
-        status = self.lib.nccf_def_data(self.dst_gridid, "dst_data", \
-                                        standard_name, units, time_dimname, \
-                                            byref(dst_dataid))
-        catchError(status, sys._getframe().f_lineno)
-        if dst_data.dtype == numpy.float64:
-            fill_value = c_double(libCFConfig.NC_FILL_DOUBLE)
+        # the data objects are not shared with concurrent calls, the GIL
+        # is released during nccf_apply_regrid so other threads can run
+        # meanwhile
+        dataIds = self._acquireDataIds()
+        try:
+            src_dataid, dst_dataid = dataIds
+
+            setData, fill_value = srcSetter
             if missingValue is not None:
-                fill_value = c_double(missingValue)
-                dst_data[:] = missingValue
-            ptr = dst_data.ctypes.data_as(POINTER(c_double))
-            status = self.lib.nccf_set_data_double(dst_dataid, ptr, save, fill_value)
-            catchError(status, sys._getframe().f_lineno)
-        elif dst_data.dtype == numpy.float32:
-            fill_value = c_float(libCFConfig.NC_FILL_FLOAT)
+                fill_value = missingValue
+            status = setData(src_dataid, src_data.ctypes.data, save, fill_value)
+            catchError(status)
+
+            setData, fill_value = dstSetter
             if missingValue is not None:
-                fill_value = c_float(missingValue)
+                fill_value = missingValue
                 dst_data[:] = missingValue
-            ptr = dst_data.ctypes.data_as(POINTER(c_float))
-            status = self.lib.nccf_set_data_float(dst_dataid, ptr, save, fill_value)
-            catchError(status, sys._getframe().f_lineno)
-        else:
-            raise RegridError, "ERROR in %s: invalid dst_data type = %s" \
-                % (__FILE__, dst_data.dtype)
+            status = setData(dst_dataid, dst_data.ctypes.data, save, fill_value)
+            catchError(status)
 
-        # Now apply weights
-        status = self.lib.nccf_apply_regrid(self.regridid, src_dataid, dst_dataid)
-        catchError(status, sys._getframe().f_lineno)
-        
-        # Clean up
-        status = self.lib.nccf_free_data(src_dataid)
-        catchError(status, sys._getframe().f_lineno)
-        status = self.lib.nccf_free_data(dst_dataid)
-        catchError(status, sys._getframe().f_lineno)
+            # Now apply weights
+            status = self.lib.nccf_apply_regrid(self.regridid, src_dataid,
+                                                dst_dataid)
+            catchError(status)
+        finally:
+            self._releaseDataIds(dataIds)
 
         return dst_data
 
-    def __call__(self, src_data, dst_data, missingValue = None):
+    def _acquireDataIds(self):
+        """
+        Get a pair of libcf src and dst data objects not used by any other
+        call, a new pair is defined when all of them are in use
+        @return src data id, dst data id
+        @note hand the pair back with _releaseDataIds
+        """
+        src_dataid = c_int(-1)
+        dst_dataid = c_int(-1)
+        standard_name = ""
+        units = ""
+        time_dimname = ""
+        self._dataLock.acquire()
+        try:
+            if self._freeData:
+                return self._freeData.pop()
+
+            status = self.lib.nccf_def_data(self.src_gridid, "src_data",
+                                            standard_name, units, time_dimname,
+                                            byref(src_dataid))
+            catchError(status)
+            self._dataIds.append(src_dataid)
+
+            status = self.lib.nccf_def_data(self.dst_gridid, "dst_data",
+                                            standard_name, units, time_dimname,
+                                            byref(dst_dataid))
+            catchError(status)
+            self._dataIds.append(dst_dataid)
+        finally:
+            self._dataLock.release()
+
+        return src_dataid, dst_dataid
+
+    def _releaseDataIds(self, dataIds):
+        """
+        Return a pair of data objects obtained from _acquireDataIds, so
+        that later calls can reuse it
+        @param dataIds src data id, dst data id
+        """
+        self._dataLock.acquire()
+        try:
+            self._freeData.append(dataIds)
+        finally:
+            self._dataLock.release()
+
+    def __call__(self, src_data, dst_data, missingValue = None,
+                 precision = None):
         """
         Apply interpolation (synonymous to apply method)
         @param src_data data on source grid
         @param dst_data data on destination grid
         @param missingValue value that should be set for points falling outside the src domain, 
                             pass None if these should not be touched.
+        @param precision 'f4' to interpolate float64 data in single
+                         precision, see apply
         """
-        self.apply(src_data, dst_data, missingValue)
+        self.apply(src_data, dst_data, missingValue, precision)
+
 
+    def materializeWeights(self):
+        """
+        Extract the interpolation weights from libcf into numpy arrays, so
+        that applyFast can interpolate without calling libcf. Called
+        automatically by applyFast.
+        @note weights must have been computed, this costs one libcf call per
+              destination point
+        """
+        if not self.weightsComputed:
+            raise RegridError, 'Weights must be set before they can be materialized'
+
+        nnodes = 2**self.rank
+        ndst = reduce(lambda x, y: x*y, self._dst_dims_tuple)
+        # destination index sets, C int like all libcf index arrays
+        dinds = numpy.ascontiguousarray(
+            numpy.transpose(numpy.unravel_index(numpy.arange(ndst),
+                                                self._dst_dims_tuple)),
+            numpy.int32)
+        sinds = numpy.zeros( (ndst, nnodes), numpy.int32 )
+        weights = numpy.zeros( (ndst, nnodes), numpy.float64 )
+        valid = numpy.zeros( (ndst,), numpy.bool_ )
+
+        inqWeights = self.lib.nccf_inq_regrid_weights
+        dindsPtr = dinds.ctypes.data
+        sindsPtr = sinds.ctypes.data
+        weightsPtr = weights.ctypes.data
+        dindsStride = dinds.strides[0]
+        sindsStride = sinds.strides[0]
+        weightsStride = weights.strides[0]
+        for i in xrange(ndst):
+            # points that could not be located by libcf are flagged
+            # by a non-zero status
+            status = inqWeights(self.regridid,
+                                dindsPtr + i*dindsStride,
+                                sindsPtr + i*sindsStride,
+                                weightsPtr + i*weightsStride)
+            valid[i] = (status == 0)
+
+        dstValid = numpy.flatnonzero(valid)
+        # a failing call is taken to be a point outside the src domain,
+        # make sure no genuine libcf error went unnoticed
+        if len(dstValid) != self.getNumValid():
+            raise RegridError, \
+                "ERROR in %s: got weights for %d points, expected %d" \
+                % (__FILE__, len(dstValid), self.getNumValid())
+
+        # stored point-major, (nvalid, nnodes): with numpy kernels a single
+        # einsum over this layout is faster than accumulating node by node
+        # over a transposed (nnodes, nvalid) layout
+        self._dst_valid = dstValid
+        self._indices = numpy.ascontiguousarray(sinds[dstValid], numpy.intp)
+        self._weights = numpy.ascontiguousarray(weights[dstValid])
+        self._applyPlans = {}
+        self._devicePlans = {}
+
+    def applyFast(self, src_data_in, dst_data, missingValue = None):
+        """
+        Apply interpolation using the weights extracted by
+        materializeWeights, libcf is not called. Gives the same result as
+        apply and is faster when the same weights are applied many times
+        (e.g. over time slices).
+        @param src_data data on source grid
+        @param dst_data data on destination grid
+        @param missingValue value that should be set for points falling outside the src domain, 
+                            pass None if these should not be touched.
+        """
+        if self._weights is None:
+            self.materializeWeights()
+        # extend src data if grid was made cyclic and or had a cut accounted for
+        src_data = self._extend(src_data_in)
+
+        # the shapes are checked and the weights cast once per combination
+        # of data shapes and types
+        key = (src_data.shape, dst_data.shape, src_data.dtype, dst_data.dtype)
+        weights = self._applyPlans.get(key)
+        if weights is None:
+            self._checkShapes(src_data, dst_data)
+            # single precision data are interpolated in single precision
+            wtype = numpy.float64
+            if src_data.dtype == numpy.float32 and \
+                    dst_data.dtype == numpy.float32:
+                wtype = numpy.float32
+            weights = numpy.ascontiguousarray(self._weights, wtype)
+            self._applyPlans[key] = weights
+
+        src = numpy.asarray(src_data).reshape(-1)
+        dst = numpy.asarray(dst_data)
+        if missingValue is not None:
+            dst[...] = missingValue
+        # weighted sum over the nodes surrounding each destination point
+        dst.flat[self._dst_valid] = numpy.einsum('ij,ij->i',
+                                                 src[self._indices],
+                                                 weights)
+        return dst_data
+
+    def applyCupy(self, src_data_in, dst_data, missingValue = None):
+        """
+        Same as applyFast but for cupy arrays, the interpolation runs on
+        the GPU. The weights are copied to the device on the first call
+        and kept there.
+        @param src_data data on source grid (cupy array)
+        @param dst_data data on destination grid (C contiguous cupy array)
+        @param missingValue value that should be set for points falling outside the src domain, 
+                            pass None if these should not be touched.
+        """
+        # optional, only loaded (with its CUDA libraries) when used
+        try:
+            import cupy
+        except ImportError:
+            raise RegridError, 'ERROR in %s: applyCupy requires cupy' % __FILE__
+        if self._weights is None:
+            self.materializeWeights()
+        src_data = self._extend(src_data_in, cupy)
+        self._checkShapes(src_data, dst_data)
+        if not dst_data.flags.c_contiguous:
+            raise RegridError, 'ERROR in %s: dst_data must be C contiguous' \
+                % __FILE__
+
+        wtype = numpy.float64
+        if src_data.dtype == numpy.float32 and dst_data.dtype == numpy.float32:
+            wtype = numpy.float32
+        plan = self._devicePlans.get(wtype)
+        if plan is None:
+            plan = (cupy.asarray(self._dst_valid),
+                    cupy.asarray(self._indices),
+                    cupy.asarray(numpy.ascontiguousarray(self._weights, wtype)))
+            self._devicePlans[wtype] = plan
+        dstValid, indices, weights = plan
+
+        src = src_data.reshape(-1)
+        dst = dst_data.reshape(-1)
+        if missingValue is not None:
+            dst.fill(missingValue)
+        dst[dstValid] = cupy.einsum('ij,ij->i', src[indices], weights)
+        return dst_data
 
     def getNumValid(self):
         """
@@ -692,7 +1012,7 @@ class Regrid:
         res = c_int(-1)
         status = self.lib.nccf_inq_regrid_nvalid(self.regridid,
                                                  byref(res))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
         return res.value
 
     def getNumDstPoints(self):
@@ -703,13 +1023,15 @@ class Regrid:
         res = c_int(-1)
         status = self.lib.nccf_inq_regrid_ntargets(self.regridid,
                                                   byref(res))
-        catchError(status, sys._getframe().f_lineno)
+        catchError(status)
         return res.value
 
     def getSrcGrid(self):
         """
         Return the source grid
         @return grid
+        @note the coordinates may be the arrays passed to the constructor,
+              and are read in place by libcf: do not modify them
         """
         return self.src_coords
 
@@ -717,6 +1039,8 @@ class Regrid:
         """
         Return the destination grid
         @return grid
+        @note the coordinates may be the arrays passed to the constructor,
+              and are read in place by libcf: do not modify them
         """
         return self.dst_coords
 
@@ -726,47 +1050,57 @@ class Regrid:
         @param dst_indices index set on the target grid
         @return [index sets on original grid, weights]
         """
-        dinds = numpy.array(dst_indices)
-        sinds = (c_int * 2**self.rank)()
+        dinds = numpy.array(dst_indices, numpy.int32)
+        sinds = numpy.zeros( (2**self.rank,), numpy.int32 )
         weights = numpy.zeros( (2**self.rank,), numpy.float64 )
         status = self.lib.nccf_inq_regrid_weights(self.regridid,
-                                                  dinds.ctypes.data_as(POINTER(c_double)),
-                                                  sinds,
-                                                  weights.ctypes.data_as(POINTER(c_double)))
-        catchError(status, sys._getframe().f_lineno)
-        # convert the flat indices to index sets
-        ori_inds = []
-        for i in range(2**self.rank):
-            inx = numpy.zeros( (self.rank,), numpy.int32 )
-            self.lib.nccf_get_multi_index(self.rank, self.src_dims,
-                                          sinds[i],
-                                          inx.ctypes.data_as(POINTER(c_int)))
-            ori_inds.append(inx)
+                                                  dinds.ctypes.data,
+                                                  sinds.ctypes.data,
+                                                  weights.ctypes.data)
+        catchError(status)
+        # convert the flat indices to index sets, one row per node
+        ori_inds = list(numpy.ascontiguousarray(
+            numpy.transpose(numpy.unravel_index(sinds, self._src_dims_tuple)),
+            numpy.int32))
 
         return ori_inds, weights
 
-    def _extend(self, src_data):
+    def _checkShapes(self, src_data, dst_data):
+        """
+        Check that the data match the (extended) src and the dst grids
+        @param src_data data on source grid, after extension
+        @param dst_data data on destination grid
+        """
+        if src_data.shape[:self.rank] != self._src_dims_tuple:
+            raise RegridError, ("ERROR in %s: supplied src_data have wrong shape " \
+                                  + "%s != %s") % (__FILE__, str(src_data.shape), \
+                                     str(self._src_dims_tuple))
+        if dst_data.shape[:self.rank] != self._dst_dims_tuple:
+            raise RegridError, ("ERROR in %s: supplied dst_data have wrong shape " \
+                + "%s != %s") % (__FILE__, str(dst_data.shape),
+                                 str(self._dst_dims_tuple))
+
+    def _extend(self, src_data, xp = numpy):
         """
         Extend the data by padding a column and a row, depending on whether the
         grid was made cyclic and a fold was added or not
         @param src_data input source data
+        @param xp array module the data belong to (numpy or cupy)
         @return extended source data (or source input data of no padding was applied)
         """
 
-        # extended dimensions
-        nlatX, nlonX = self.src_dims[-2], self.src_dims[-1]
+        # no cut and no cyclic extension
+        if not (self.handleCut or self.extendedGrid):
+            return src_data
+
         # original dimensions, before extension
         # assuming ..., lat, lon ordering
         nlat, nlon = src_data.shape[-2:]
 
-        # no cut and no cyclic extension
-        src_dataNew = src_data
-
-        if self.handleCut or self.extendedGrid:
-            # copy data into new, extended container
-            src_dataNew = numpy.zeros(self.src_dims, src_data.dtype)
-            # start filling in...
-            src_dataNew[..., :nlat, :nlon] = src_data[...]
+        # copy data into new, extended container
+        src_dataNew = xp.zeros(self._src_dims_tuple, src_data.dtype)
+        # start filling in...
+        src_dataNew[..., :nlat, :nlon] = src_data[...]
 
         if self.handleCut:
             # fill in polar cut (e.g. tripolar cut), top row
@@ -790,33 +1124,124 @@ class Regrid:
         @param dindicesGuess guess for the floating point indices
         @return indices, number of iterations, achieved tolerance
         """
-        posPtr = targetPos.ctypes.data_as(POINTER(c_double))
         adjustFunc = None
-        hit_bounds = numpy.zeros((self.rank),
-                                  dtype = int).ctypes.data_as(POINTER(c_int))
-        # no periodicity
-        coord_periodicity = float('inf') * numpy.ones((self.rank), targetPos.dtype)
-        coord_periodicity_ptr = coord_periodicity.ctypes.data_as(POINTER(c_double))
-        res = copy.copy(dindicesGuess)
-        resPtr = res.ctypes.data_as(POINTER(c_double))
-        src_coords = (POINTER(c_double) * self.rank)()
+        hit_bounds = numpy.zeros((self.rank), dtype = numpy.int32)
+        # libcf expects packed double arrays
+        pos = numpy.ascontiguousarray(targetPos, numpy.float64)
+        res = numpy.array(dindicesGuess, numpy.float64, order = "C")
         niter = c_int(nitermax)
         tol = c_double(tolpos)
-        for i in range(self.rank):
-            ptr = self.src_coords[i].ctypes.data_as(POINTER(c_double))
-            src_coords[i] = ptr
         status = self.lib.nccf_find_indices_double(self.rank,
                                                    self.src_dims,
-                                                   src_coords,
-                                                   coord_periodicity_ptr,
-                                                   posPtr,
+                                                   self._src_coord_ptrs,
+                                                   self._no_periodicity.ctypes.data,
+                                                   pos.ctypes.data,
                                                    byref(niter),
                                                    byref(tol),
                                                    adjustFunc,
-                                                   resPtr,
-                                                   hit_bounds)
-        catchError(status, sys._getframe().f_lineno)
-        return resPtr.contents.value, niter.value, tol.value
+                                                   res.ctypes.data,
+                                                   hit_bounds.ctypes.data)
+        catchError(status)
+        return res[0], niter.value, tol.value
+
+    def _findIndicesBatch(self, targetPos, nitermax, tolpos,
+                          dindicesGuess, nthreads = 1):
+        """
+        Find the floating point indices of many target positions at once
+        @param targetPos numpy array of target positions, shape (npts, rank)
+        @param nitermax max number of iterations
+        @param tolpos max tolerance in positions
+        @param dindicesGuess guess for the floating point indices, either
+                             a single guess of shape (rank,) or one guess
+                             per target position, shape (npts, rank)
+        @param nthreads number of threads the target positions are
+                        split across
+        @return indices (npts, rank), number of iterations (npts,),
+                achieved tolerances (npts,)
+        @note all the buffers are set up once, the loop over target
+              positions only calls nccf_find_indices_double. ctypes
+              releases the GIL during the call so that the threads
+              search in parallel.
+        """
+        pos = numpy.ascontiguousarray(targetPos, numpy.float64)
+        if len(pos.shape) != 2 or pos.shape[1] != self.rank:
+            raise RegridError, \
+                "ERROR in %s: targetPos must have shape (npts, %d), got %s" \
+                % (__FILE__, self.rank, str(pos.shape))
+        npts = pos.shape[0]
+
+        res = numpy.empty((npts, self.rank), numpy.float64)
+        res[:] = dindicesGuess
+        niters = numpy.empty((npts,), numpy.int32)
+        tols = numpy.empty((npts,), numpy.float64)
+
+        nthreads = max(1, min(nthreads, npts))
+        if nthreads == 1:
+            self._findIndicesRange(pos, nitermax, tolpos,
+                                   res, niters, tols, 0, npts)
+            return res, niters, tols
+
+        # each thread works on its own contiguous range of points
+        errors = []
+        def worker(begin, end):
+            try:
+                self._findIndicesRange(pos, nitermax, tolpos,
+                                       res, niters, tols, begin, end)
+            except Exception, e:
+                errors.append(e)
+        bounds = numpy.linspace(0, npts, nthreads + 1).astype(numpy.int64)
+        threads = [threading.Thread(target = worker,
+                                    args = (bounds[i], bounds[i + 1]))
+                   for i in range(nthreads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return res, niters, tols
+
+    def _findIndicesRange(self, pos, nitermax, tolpos,
+                          res, niters, tols, begin, end):
+        """
+        Find the floating point indices of target positions begin...end-1,
+        filling in res, niters and tols in place
+        @param pos contiguous float64 array of target positions, shape
+                   (npts, rank)
+        @param nitermax max number of iterations
+        @param tolpos max tolerance in positions
+        @param res contiguous float64 array (npts, rank), initial guesses on
+                   input, floating point indices on output
+        @param niters int32 array (npts,), number of iterations on output
+        @param tols float64 array (npts,), achieved tolerances on output
+        @param begin first target position
+        @param end one past the last target position
+        @note the scratch buffers are local so that disjoint ranges can be
+              processed concurrently
+        """
+        hit_bounds = numpy.zeros((self.rank,), numpy.int32)
+        niter = c_int(nitermax)
+        tol = c_double(tolpos)
+        niterRef = byref(niter)
+        tolRef = byref(tol)
+
+        findIndices = self.lib.nccf_find_indices_double
+        periodicityPtr = self._no_periodicity.ctypes.data
+        hitBoundsPtr = hit_bounds.ctypes.data
+        posPtr = pos.ctypes.data
+        resPtr = res.ctypes.data
+        stride = res.strides[0]
+        for i in xrange(begin, end):
+            niter.value = nitermax
+            tol.value = tolpos
+            offset = i * stride
+            status = findIndices(self.rank, self.src_dims,
+                                 self._src_coord_ptrs, periodicityPtr,
+                                 posPtr + offset, niterRef, tolRef, None,
+                                 resPtr + offset, hitBoundsPtr)
+            catchError(status)
+            niters[i] = niter.value
+            tols[i] = tol.value
 
 ######################################################################
 
@@ -62,9 +62,12 @@ class LibCFRegrid(GenericRegrid):
         @param missingValue value that should be set for points falling outside 
                             the src domain, pass None if these should not be 
                             touched.        
+        @param **args keyword arguments, eg precision = 'f4' to interpolate
+                      float64 data in single precision
         """
         
-        self.regridObj.apply(srcData, dstData, missingValue)
+        self.regridObj.apply(srcData, dstData, missingValue,
+                             precision = args.get('precision', None))
 
     def getSrcGrid(self):
         """
@@ -0,0 +1,204 @@
+"""
+Unit tests for regrid2.gsRegrid using small analytic grids (no data files)
+"""
+
+import regrid2
+from regrid2 import gsRegrid
+import numpy
+import unittest
+
+HAVE_CUPY = False
+try:
+    import cupy
+    HAVE_CUPY = True
+except:
+    pass
+
+class TestGsRegrid(unittest.TestCase):
+
+    def setUp(self):
+        self.x = numpy.array([1., 2., 3., 4., 5., 6.])
+        self.y = numpy.array([10., 20., 30., 40., 50.])
+        self.z = numpy.array([100., 200.])
+
+    def test1_getTensorProduct(self):
+        dims = [len(self.z), len(self.y), len(self.x)]
+        for dim, axis in enumerate([self.z, self.y, self.x]):
+            ref = numpy.outer(numpy.outer(numpy.ones(dims[:dim]), axis),
+                              numpy.ones(dims[dim+1:])).reshape(dims)
+            res = gsRegrid.getTensorProduct(axis, dim, dims)
+            self.assertEqual(res.shape, tuple(dims))
+            self.assertEqual(res.dtype, axis.dtype)
+            self.assertTrue(numpy.all(res == ref))
+
+    def test2_makeCurvilinear(self):
+        dims2 = [len(self.y), len(self.x)]
+        yy = gsRegrid.getTensorProduct(self.y, 0, dims2)
+        xx = gsRegrid.getTensorProduct(self.x, 1, dims2)
+        coords, dims = gsRegrid.makeCurvilinear([self.z, yy, xx])
+        self.assertEqual(dims, [len(self.z), len(self.y), len(self.x)])
+        for c in coords:
+            self.assertEqual(c.shape, tuple(dims))
+        self.assertEqual(coords[0][1, 2, 3], self.z[1])
+        self.assertEqual(coords[1][1, 2, 3], self.y[2])
+        self.assertEqual(coords[2][1, 2, 3], self.x[3])
+        # fully curvilinear coordinates are returned as is
+        coords2, dims2 = gsRegrid.makeCurvilinear(list(coords))
+        self.assertEqual(dims2, dims)
+        for c, c2 in zip(coords, coords2):
+            self.assertTrue(c2 is c)
+        # 2D coordinates inconsistent with the axes
+        self.assertRaises(regrid2.RegridError, gsRegrid.makeCurvilinear,
+                          [self.z, self.y[:3], xx[:3, :4]])
+        self.assertRaises(regrid2.RegridError, gsRegrid.makeCurvilinear,
+                          [self.z, yy[:2, :3], xx[:4, :5]])
+
+    def test3_applyWrongShape(self):
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y[:-1], self.x[:-1]])
+        rg.computeWeights(20, 1.e-3)
+        srcData = numpy.zeros((len(self.y), len(self.x)), numpy.float64)
+        dstData = numpy.zeros((len(self.y) - 1, len(self.x) - 1), numpy.float64)
+        rg.apply(srcData, dstData)
+        self.assertRaises(regrid2.RegridError, rg.apply, dstData, dstData)
+        self.assertRaises(regrid2.RegridError, rg.apply, srcData, srcData)
+
+    def test4_findIndicesBatch(self):
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y[:-1], self.x[:-1]])
+        targetPos = numpy.array([[15., 1.5], [22., 2.5], [47., 5.5]])
+        guess = numpy.zeros((2,), numpy.float64)
+        inds, niters, tols = rg._findIndicesBatch(targetPos, 20, 1.e-3, guess)
+        self.assertEqual(inds.shape, targetPos.shape)
+        for i in range(len(targetPos)):
+            ind, niter, tol = rg._findIndices(targetPos[i], 20, 1.e-3,
+                                              guess.copy())
+            self.assertAlmostEqual(inds[i, 0], ind)
+            self.assertEqual(niters[i], niter)
+        self.assertRaises(regrid2.RegridError, rg._findIndicesBatch,
+                          targetPos[:, :1], 20, 1.e-3, guess)
+        # threaded search gives the same answer
+        inds2, niters2, tols2 = rg._findIndicesBatch(targetPos, 20, 1.e-3,
+                                                     guess, nthreads = 2)
+        self.assertTrue(numpy.all(inds2 == inds))
+        self.assertTrue(numpy.all(niters2 == niters))
+
+    def test5_applyFromThreads(self):
+        import threading
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y[:-1] + 1., self.x[:-1] + .5])
+        rg.computeWeights(20, 1.e-3)
+        yy, xx = rg.getSrcGrid()
+        fields = [numpy.array(yy * xx + i, numpy.float64) for i in range(16)]
+        dstShape = rg.getDstGrid()[0].shape
+        expected = []
+        for f in fields:
+            expected.append(rg.apply(f, numpy.zeros(dstShape, numpy.float64)))
+        results = [numpy.zeros(dstShape, numpy.float64) for f in fields]
+        # one thread per field, at most nthreads of them at a time
+        nthreads = 4
+        for begin in range(0, len(fields), nthreads):
+            threads = [threading.Thread(target = rg.apply,
+                                        args = (fields[i], results[i]))
+                       for i in range(begin, begin + nthreads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        for i in range(len(fields)):
+            self.assertTrue(numpy.all(results[i] == expected[i]))
+        # the libcf data objects are reused, their number is bounded by
+        # the number of concurrent calls, not the number of threads
+        self.assertTrue(len(rg._dataIds) <= 2 * nthreads)
+        self.assertEqual(len(rg._freeData) * 2, len(rg._dataIds))
+
+    def test6_applySinglePrecision(self):
+        # destination extends beyond the source domain
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y + 5., self.x + .5])
+        rg.computeWeights(20, 1.e-3)
+        yy, xx = rg.getSrcGrid()
+        srcData = numpy.array(yy * xx, numpy.float64)
+        dstShape = rg.getDstGrid()[0].shape
+        missingValue = 1.e20
+        dst64 = rg.apply(srcData, numpy.zeros(dstShape, numpy.float64),
+                         missingValue)
+        dst32 = rg.apply(srcData, numpy.zeros(dstShape, numpy.float64),
+                         missingValue, precision = 'f4')
+        self.assertEqual(dst32.dtype, numpy.float64)
+        valid = (dst64 != missingValue)
+        self.assertTrue(numpy.any(valid))
+        self.assertTrue(numpy.all(valid == (dst32 != missingValue)))
+        self.assertLess(abs(dst32[valid] - dst64[valid]).max(),
+                        1.e-5 * abs(dst64[valid]).max())
+        # without missing value, points outside the src domain are not
+        # touched, also when the src data contain NaN or values that
+        # overflow in single precision. The dst x coordinates coincide
+        # with src nodes, some nodes get a zero weight (inf * 0 = NaN)
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y + 5., self.x])
+        rg.computeWeights(20, 1.e-3)
+        srcData = numpy.array(yy * xx, numpy.float64)
+        dstShape = rg.getDstGrid()[0].shape
+        init = 0.1234567890123
+        for badValue in None, 1.e39, numpy.nan:
+            if badValue is not None:
+                srcData[0, 1] = badValue
+            dst64 = rg.apply(srcData, numpy.zeros(dstShape, numpy.float64) + init)
+            dst32 = rg.apply(srcData, numpy.zeros(dstShape, numpy.float64) + init,
+                             precision = 'f4')
+            valid = (dst64 != init)
+            self.assertEqual(valid.sum(), rg.getNumValid())
+            self.assertTrue(numpy.all(dst32[~valid] == init))
+            self.assertTrue(numpy.all(dst32[valid] != init))
+            ok = valid & numpy.isfinite(dst64) & numpy.isfinite(dst32)
+            self.assertLess(abs(dst32[ok] - dst64[ok]).max(),
+                            1.e-5 * abs(dst64[ok]).max())
+
+    def test7_applyFast(self):
+        src = [self.z, self.y, self.x]
+        dst = [self.z + 10., self.y + 5., self.x + .5]
+        rg = gsRegrid.Regrid(src, dst)
+        rg.computeWeights(20, 1.e-3)
+        zz, yy, xx = rg.getSrcGrid()
+        dstShape = rg.getDstGrid()[0].shape
+        missingValue = 1.e20
+        for dtype in numpy.float32, numpy.float64:
+            srcData = numpy.array(zz * yy + xx, dtype)
+            ref = rg.apply(srcData, numpy.zeros(dstShape, dtype), missingValue)
+            res = rg.applyFast(srcData, numpy.zeros(dstShape, dtype),
+                               missingValue)
+            self.assertEqual(res.dtype, dtype)
+            valid = (ref != missingValue)
+            self.assertEqual(valid.sum(), rg.getNumValid())
+            self.assertTrue(numpy.all(valid == (res != missingValue)))
+            self.assertLess(abs(res[valid] - ref[valid]).max(),
+                            1.e-5 * abs(ref[valid]).max())
+        # shapes are still checked once the call has been specialized
+        self.assertRaises(regrid2.RegridError, rg.applyFast,
+                          srcData, srcData[:, :-1, :])
+        # weights inconsistent with libcf's count of valid points are
+        # rejected and not kept
+        rg = gsRegrid.Regrid(src, dst)
+        rg.computeWeights(20, 1.e-3)
+        rg.getNumValid = lambda: -1
+        self.assertRaises(regrid2.RegridError, rg.materializeWeights)
+        self.assertTrue(rg._dst_valid is None)
+        self.assertTrue(rg._weights is None)
+
+    @unittest.skipUnless(HAVE_CUPY, 'requires cupy')
+    def test8_applyCupy(self):
+        rg = gsRegrid.Regrid([self.y, self.x], [self.y + 5., self.x + .5])
+        rg.computeWeights(20, 1.e-3)
+        yy, xx = rg.getSrcGrid()
+        dstShape = rg.getDstGrid()[0].shape
+        missingValue = 1.e20
+        for dtype in numpy.float32, numpy.float64:
+            srcData = numpy.array(yy * xx, dtype)
+            ref = rg.applyFast(srcData, numpy.zeros(dstShape, dtype),
+                               missingValue)
+            res = rg.applyCupy(cupy.asarray(srcData),
+                               cupy.zeros(dstShape, dtype), missingValue)
+            res = cupy.asnumpy(res)
+            self.assertEqual(res.dtype, dtype)
+            self.assertLess(abs(res - ref).max(), 1.e-5 * abs(ref).max())
+
+if __name__ == '__main__':
+    print ""
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGsRegrid)
+    unittest.TextTestRunner(verbosity = 1).run(suite)